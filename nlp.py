@@ -3,9 +3,15 @@
 # (Written for the second edition of AIMA; expect some discrepanciecs
 # from the third edition until this gets reviewed.)
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import networkx as nx
-from math import sqrt
+import numpy as np
+from scipy import sparse
+
+try:
+    from numba import njit
+except ImportError:  # Numba is optional; without it CYK_parse uses NumPy vectorization
+    njit = None
 
 # ______________________________________________________________________________
 # Grammars and Lexicons
@@ -36,12 +42,84 @@ class Grammar:
     def __init__(self, name, rules, lexicon):
         "A grammar has a set of rules and a lexicon."
         self.name = name
-        self.rules = rules
+        self.rules = {lhs: tuple(tuple(rhs) for rhs in alts) for (lhs, alts) in rules.items()}
         self.lexicon = lexicon
-        self.categories = defaultdict(list)
+        categories = defaultdict(list)
         for lhs in lexicon:
             for word in lexicon[lhs]:
-                self.categories[word].append(lhs)
+                categories[word].append(lhs)
+        self.categories = {word: frozenset(cats) for (word, cats) in categories.items()}
+        # What kind of symbol each symbol is: 'R' if it has rules, 'L' if it
+        # has lexicon entries, 'T' (terminal) otherwise. Rules take precedence.
+        self.kind = dict.fromkeys(lexicon, 'L')
+        self.kind.update(dict.fromkeys(self.rules, 'R'))
+        self.to_cnf()
+
+    def to_cnf(self):
+        """Compute the Chomsky Normal Form of the grammar, for CYK_parse: binary
+        rules (X, Y, Z, p) in self.cnf_rules_list, and (X, p) pairs for each word
+        in self.cnf_lexicon. The grammar has no probabilities, so each alternative
+        for X gets 1/len(rules[X]) and each word of a category C 1/len(lexicon[C]).
+        Longer right-hand sides are split up with fresh symbols named X_1, X_2, ...
+        and unit rules X -> Y are folded into the rules and words Y derives.
+        Empty right-hand sides are dropped."""
+        binary = defaultdict(list)  # binary[X] = [(Y, Z, p), ...]
+        units = defaultdict(dict)   # units[X][Y] = p for the rule X -> Y
+        fresh = 0
+        for (X, alts) in self.rules.items():
+            for rhs in alts:
+                p = 1 / len(alts)
+                if not rhs:  # CNF has no empty rules; CYK_parse just ignores them
+                    continue
+                if len(rhs) == 1:
+                    units[X][rhs[0]] = max(p, units[X].get(rhs[0], 0))
+                    continue
+                lhs = X
+                while len(rhs) > 2:
+                    fresh += 1
+                    while '%s_%d' % (X, fresh) in self.kind:
+                        fresh += 1
+                    new = '%s_%d' % (X, fresh)
+                    binary[lhs].append((rhs[0], new, p))
+                    lhs, rhs, p = new, rhs[1:], 1.0
+                binary[lhs].append((rhs[0], rhs[1], p))
+        # closure[X][Y] = probability of the likeliest chain of unit rules X -> ... -> Y
+        closure = {X: {X: 1.0} for X in set(self.lexicon) | set(binary) | set(units)}
+        changed = True
+        while changed:
+            changed = False
+            for reach in closure.values():
+                for (Y, q) in list(reach.items()):
+                    for (Z, p) in units.get(Y, {}).items():
+                        if q * p > reach.get(Z, 0):
+                            reach[Z] = q * p
+                            changed = True
+        rules = {}
+        lexicon = defaultdict(dict)
+        for (X, reach) in closure.items():
+            for (Y, q) in reach.items():
+                for (A, B, p) in binary.get(Y, ()):
+                    rules[X, A, B] = max(q * p, rules.get((X, A, B), 0))
+                for word in self.lexicon.get(Y, ()):
+                    p = q / len(self.lexicon[Y])
+                    lexicon[word][X] = max(p, lexicon[word].get(X, 0))
+        self.cnf_rules_list = [(X, Y, Z, p) for ((X, Y, Z), p) in rules.items()]
+        self.cnf_lexicon = {word: list(cats.items()) for (word, cats) in lexicon.items()}
+        # Number the symbols, so that CYK_parse can index a dense array by symbol,
+        # and pack the rules into parallel arrays of symbol ids and log probabilities.
+        symbols = set(closure) | {Y for (X, Y, Z, p) in self.cnf_rules_list} | \
+            {Z for (X, Y, Z, p) in self.cnf_rules_list}
+        self.id2sym = sorted(symbols)
+        self.sym2id = {X: i for (i, X) in enumerate(self.id2sym)}
+        rules = self.cnf_rules_list
+        self.cnf_arrays = (np.array([self.sym2id[X] for (X, Y, Z, p) in rules], dtype=np.int64),
+                           np.array([self.sym2id[Y] for (X, Y, Z, p) in rules], dtype=np.int64),
+                           np.array([self.sym2id[Z] for (X, Y, Z, p) in rules], dtype=np.int64),
+                           np.log(np.array([p for (X, Y, Z, p) in rules])).astype(np.float32))
+
+    def cnf_rules(self):
+        "Return a sequence of (X, Y, Z, p) tuples: the binary rules X -> Y Z with probability p."
+        return self.cnf_rules_list
 
     def rewrites_for(self, cat):
         "Return a sequence of possible rhs's that cat can be rewritten as."
@@ -49,7 +127,7 @@ class Grammar:
 
     def isa(self, word, cat):
         "Return True iff word is of category cat"
-        return cat in self.categories[word]
+        return cat in self.categories.get(word, ())
 
     def __repr__(self):
         return '<Grammar %s>' % self.name
@@ -102,9 +180,10 @@ def generate_random(grammar=E_, s='S'):
 
     def rewrite(tokens, into):
         for token in tokens:
-            if token in grammar.rules:
+            kind = grammar.kind.get(token, 'T')
+            if kind == 'R':
                 rewrite(random.choice(grammar.rules[token]), into)
-            elif token in grammar.lexicon:
+            elif kind == 'L':
                 into.append(random.choice(grammar.lexicon[token]))
             else:
                 into.append(token)
@@ -116,6 +195,41 @@ def generate_random(grammar=E_, s='S'):
 # Chart Parsing
 
 
+class Edge(namedtuple('Edge', 'start end lhs rhs dot parent child')):
+    """An edge spanning words[start:end] for the rule lhs -> rhs, of which the
+    symbols rhs[:dot] have been found and the rest are still expected.
+    The edge was made by extending parent (the same rule with dot one less)
+    with child, a (category, word) pair or a complete Edge; an edge with
+    dot == 0 has neither."""
+    __slots__ = ()
+
+    @property
+    def found(self):
+        "The children found so far, in order."
+        found = []
+        edge = self
+        while edge.parent is not None:
+            found.append(edge.child)
+            edge = edge.parent
+        found.reverse()
+        return tuple(found)
+
+    @property
+    def expects(self):
+        return self.rhs[self.dot:]
+
+    def __repr__(self):
+        "Show the span and dotted rule only, e.g. [0:3 S -> NP . VP]; not the whole derivation."
+        rhs = self.rhs[:self.dot] + ('.',) + self.rhs[self.dot:]
+        return '[%d:%d %s -> %s]' % (self.start, self.end, self.lhs, ' '.join(rhs))
+
+
+def parse_tree(edge):
+    """Return the tree built by a complete edge, as nested (lhs, children) tuples
+    with (category, word) pairs at the leaves."""
+    return (edge.lhs, tuple(parse_tree(x) if isinstance(x, Edge) else x for x in edge.found))
+
+
 class Chart:
 
     """Class for parsing sentences using a chart data structure. [Figure 22.7]
@@ -126,10 +240,14 @@ class Chart:
 
     def __init__(self, grammar, trace=False):
         """A datastructure for parsing a string; and methods to do the parse.
-        self.chart[i] holds the edges that end just before the i'th word.
-        Edges are 5-element lists of [start, end, lhs, [found], [expects]]."""
+        self.chart[i] holds the edges that end just before the i'th word, in the
+        order they were added; the parser itself only reaches edges through the
+        _expecting and _completed indexes, so self.chart is never scanned.
+        Edges are Edge tuples of (start, end, lhs, rhs, dot, parent, child)."""
         self.grammar = grammar
         self.trace = trace
+        # The rhs tuples for each category, as the predictor needs them
+        self._predict = grammar.rules
 
     def parses(self, words, S='S'):
         """Return a list of parses; words can be a list or string."""
@@ -138,76 +256,123 @@ class Chart:
         self.parse(words, S)
         # Return all the parses that span the whole input
         # 'span the whole input' => begin at 0, end at len(words)
-        return [[i, j, S, found, []]
-                for (i, j, lhs, found, expects) in self.chart[len(words)]
-                # assert j == len(words)
-                if i == 0 and lhs == S and expects == []]
+        return [edge for edge in self._completed[len(words)][S] if edge.start == 0]
 
     def parse(self, words, S='S'):
         """Parse a list of words; according to the grammar.
         Leave results in the chart."""
         self.chart = [[] for i in range(len(words)+1)]
-        self.add_edge([0, 0, 'S_', [], [S]])
+        # self._seen[i] holds a key for each edge in self.chart[i]
+        self._seen = [set() for i in range(len(words)+1)]
+        # self._expecting[i][B] lists the edges in self.chart[i] whose next expected symbol is B
+        self._expecting = [defaultdict(list) for i in range(len(words)+1)]
+        # self._completed[i][A] lists the complete edges for A in self.chart[i]
+        self._completed = [defaultdict(list) for i in range(len(words)+1)]
+        self.add_edge(Edge(0, 0, 'S_', (S,), 0, None, None))
         for i in range(len(words)):
             self.scanner(i, words[i])
         return self.chart
 
     def add_edge(self, edge):
         "Add edge to chart, and see if it extends or predicts another edge."
-        start, end, lhs, found, expects = edge
-        if edge not in self.chart[end]:
+        start, end, lhs, rhs, dot, parent, child = edge
+        # The parent and any child edge are themselves chart edges, so their
+        # identity stands in for their value; this saves hashing the whole subtree.
+        key = (start, lhs, rhs, dot, id(parent), id(child) if isinstance(child, Edge) else child)
+        if key not in self._seen[end]:
+            self._seen[end].add(key)
             self.chart[end].append(edge)
+            if dot < len(rhs):
+                self._expecting[end][rhs[dot]].append(edge)
+            else:
+                self._completed[end][lhs].append(edge)
             if self.trace:
                 print('Chart: added %s' % (edge,))
-            if not expects:
+            if dot == len(rhs):
                 self.extender(edge)
             else:
                 self.predictor(edge)
 
     def scanner(self, j, word):
         "For each edge expecting a word of this category here, extend the edge."  # noqa
-        for (i, j, A, alpha, Bb) in self.chart[j]:
-            if Bb and self.grammar.isa(word, Bb[0]):
-                self.add_edge([i, j+1, A, alpha + [(Bb[0], word)], Bb[1:]])
+        for cat in self.grammar.categories.get(word, ()):
+            for edge in self._expecting[j][cat]:
+                (i, j, A, rhs, dot, _, _) = edge
+                self.add_edge(Edge(i, j+1, A, rhs, dot+1, edge, (cat, word)))
 
     def predictor(self, edge):
         "Add to chart any rules for B that could help extend this edge."
-        (i, j, A, alpha, Bb) = edge
-        B = Bb[0]
-        if B in self.grammar.rules:
-            for rhs in self.grammar.rewrites_for(B):
-                self.add_edge([j, j, B, [], rhs])
+        j = edge.end
+        B = edge.rhs[edge.dot]
+        for rhs in self._predict.get(B, ()):
+            self.add_edge(Edge(j, j, B, rhs, 0, None, None))
 
     def extender(self, edge):
         "See what edges can be extended by this edge."
-        (j, k, B, _, _) = edge
-        for (i, j, A, alpha, B1b) in self.chart[j]:
-            if B1b and B == B1b[0]:
-                self.add_edge([i, k, A, alpha + [edge], B1b[1:]])
+        (j, k, B, _, _, _, _) = edge
+        for old in self._expecting[j][B]:
+            (i, j, A, rhs, dot, _, _) = old
+            self.add_edge(Edge(i, k, A, rhs, dot+1, old, edge))
 
 
 # ______________________________________________________________________________
 # CYK Parsing
 
 def CYK_parse(words, grammar):
-    "[Figure 23.5]"
+    """[Figure 23.5] Return a dict P where P[X, start, length] is the probability
+    of the most likely X spanning words[start:start+length]."""
     # We use 0-based indexing instead of the book's 1-based.
     N = len(words)
-    P = defaultdict(float)
+    # P holds log probabilities: products of many float32 probabilities
+    # would underflow to 0 on long sentences.
+    X_ids, Y_ids, Z_ids, logprobs = grammar.cnf_arrays
+    P = np.full((len(grammar.id2sym), N, N+1), -np.inf, dtype=np.float32)
     # Insert lexical rules for each word.
     for (i, word) in enumerate(words):
-        for (X, p) in grammar.categories[word]: # XXX grammar.categories needs changing, above
-            P[X, i, 1] = p
-    # Combine first and second parts of right-hand sides of rules,
-    # from short to long.
+        for (X, p) in grammar.cnf_lexicon.get(word, ()):
+            P[grammar.sym2id[X], i, 1] = np.log(p)
+    _cyk_combine(P, X_ids, Y_ids, Z_ids, logprobs, N)
+    # Report the nonzero probabilities by symbol name.
+    table = defaultdict(float)
+    for (x, start, length) in zip(*np.nonzero(P > -np.inf)):
+        p = np.exp(np.float64(P[x, start, length]))
+        table[grammar.id2sym[x], int(start), int(length)] = float(p)
+    return table
+
+
+def _cyk_combine_loops(P, X_ids, Y_ids, Z_ids, logprobs, N):
+    """Combine first and second parts of right-hand sides of rules,
+    from short to long, filling in the log probabilities P in place."""
     for length in range(2, N+1):
         for start in range(N-length+1):
-            for len1 in range(1, length): # N.B. the book incorrectly has N instead of length
+            for len1 in range(1, length):  # N.B. the book incorrectly has N instead of length
                 len2 = length - len1
-                for (X, Y, Z, p) in grammar.cnf_rules(): # XXX grammar needs this method
-                    P[X, start, length] = max(P[X, start, length],
-                                              P[Y, start, len1] * P[Z, start+len1, len2] * p)
-    return P
+                for r in range(len(logprobs)):
+                    p = P[Y_ids[r], start, len1] + P[Z_ids[r], start+len1, len2] + logprobs[r]
+                    if p > P[X_ids[r], start, length]:
+                        P[X_ids[r], start, length] = p
+
+
+def _cyk_combine_vectorized(P, X_ids, Y_ids, Z_ids, logprobs, N):
+    """Same as _cyk_combine_loops, but for each length handle all rules, start
+    positions and split points at once with NumPy broadcasting."""
+    for length in range(2, N+1):
+        starts = np.arange(N-length+1)[None, :, None]
+        len1 = np.arange(1, length)[None, None, :]
+        # left[r, start, k] = P[Y_r, start, len1_k]; right likewise for Z_r and the rest
+        left = P[Y_ids[:, None, None], starts, len1]
+        right = P[Z_ids[:, None, None], starts+len1, length-len1]
+        best = (left + right).max(axis=2) + logprobs[:, None]
+        # Several rules may share a lhs X, so take the maximum per X.
+        np.maximum.at(P[:, :N-length+1, length], X_ids, best)
+
+
+if njit is not None:
+    _cyk_combine = njit(cache=True)(_cyk_combine_loops)
+else:
+    _cyk_combine = _cyk_combine_vectorized
+
+
 # Borrowed from: http://hipolabs.com/en/blog/network-analysis-fundamentals/
 network = {
     "fatih": ["erdem", "mehmetbarancay", "tayyiperdogdu", "cemal",
@@ -264,19 +429,33 @@ class Pages:
     """"""
     def __init__(self, data):
         self.graph = nx.DiGraph()
-        # First thing to do is to add the nodes to the graph
-        self.graph.add_nodes_from(Page(p) for p in data.keys())
-
-        for pages in data.values():
-            for page in pages:
-                p = Page(page)
-                if p not in self.graph:
-                    self.graph.add_node(p)
-
-        # Then we determine the edges on the nodes
-        for page, out_links in data.items():
-            for out_page in out_links:
-                self.graph.add_edge(Page(page), Page(out_page))
+        # Each page name maps to a single Page object, shared by every edge
+        self._pool = {}
+        # Add the nodes, so that pages without links are kept too, then add
+        # all the edges at once; linked-to pages are added along with them.
+        self.graph.add_nodes_from(self._page(p) for p in data.keys())
+        self.graph.add_edges_from((self._page(page), self._page(out_page))
+                                  for (page, out_links) in data.items()
+                                  for out_page in out_links)
+
+        # Sparse adjacency matrix: A[i, j] is 1 iff nodes[i] links to nodes[j]
+        self.nodes = list(self.graph)
+        self.index = {p.name: i for (i, p) in enumerate(self.nodes)}
+        rows = [self.index[u.name] for (u, v) in self.graph.edges()]
+        cols = [self.index[v.name] for (u, v) in self.graph.edges()]
+        n = len(self.nodes)
+        self.A = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+
+        # Link lists are fixed once the graph is built, so store them as tuples
+        # rather than walking the graph's adjacency dicts on every query.
+        self._inlinks = {p: tuple(self.graph.predecessors(p)) for p in self.nodes}
+        self._outlinks = {p: tuple(self.graph.successors(p)) for p in self.nodes}
+
+    def _page(self, name):
+        "Return the unique Page object for this name, creating it if needed."
+        if name not in self._pool:
+            self._pool[name] = Page(name)
+        return self._pool[name]
 
     def __iter__(self):
         return self.graph
@@ -292,47 +471,69 @@ class Pages:
     def expand(self, pages):
         expansion = set(pages)
         for p in pages:
-            expansion.update(self.graph.predecessors(p))
-            expansion.update(self.graph.successors(p))
+            expansion.update(self._inlinks[p])
+            expansion.update(self._outlinks[p])
         return expansion
 
     def inlinks(self, page):
-        return self.graph.predecessors_iter(page)
+        return self._inlinks[page]
 
     def outlinks(self, page):
-        return self.graph.successors_iter(page)
-
+        return self._outlinks[page]
 
-def normalize(pages):
-    # Calculate sum of square roots for hubs and authorities
-    hub_score = sum(sqrt(p.hub) for p in pages)
-    auth_score = sum(sqrt(p.authority) for p in pages)
 
-    for p in pages:
-        p.hub /= hub_score
-        p.authority /= auth_score
-
-
-def HITS(query, dataset, num_iters=10000):
-    pages = dataset.expand(dataset.relevant(query))
+def HITS(query, dataset, max_iters=200, tol=1e-8):
+    pages = list(dataset.expand(dataset.relevant(query)))
     print([p.name for p in pages])
 
-    # This is unnecessary, but following the pseudocode closely.
+    [scores] = HITS_batch([query], dataset, max_iters, tol, dtype=np.float64)
     for p in pages:
-        p.hub = 1
-        p.authority = 1
-
-    # Since the book doesn't cover any convergence criteria,
-    # we repeat the process num_iters times.
-    for __ in range(num_iters):
-        for p in pages:
-            p.authority = sum(inlink.hub for inlink in dataset.inlinks(p))
-            p.hub = sum(outlink.authority for outlink in dataset.outlinks(p))
-
-        normalize(pages)
+        p.hub, p.authority = scores[p.name]
     return pages
 
 
-r = HITS("fatih", Pages(network))
-pr = '\n'.join("{}:\t{}, {}".format(p.name, p.hub, p.authority) for p in r)
-print(pr)
+def HITS_batch(queries, dataset, max_iters=200, tol=1e-8, dtype=np.float32):
+    """Run HITS for several queries at once. Return a list with, for each query,
+    a dict mapping the name of each page in its expanded set to (hub, authority).
+    The scores of all queries are the columns of one matrix (float32 by default),
+    so each iteration is two sparse matrix products over the whole batch.
+    tol is raised to at least 8 machine epsilons of dtype (about 1e-6 for float32),
+    since smaller changes are just rounding and would never stop the iteration."""
+    n = len(dataset.nodes)
+    # mask[i, q] is 1 iff dataset.nodes[i] is in the expanded set of query q.
+    # Multiplying by it restricts the link matrix to that set of pages.
+    mask = np.zeros((n, len(queries)), dtype=dtype)
+    for (q, query) in enumerate(queries):
+        for p in dataset.expand(dataset.relevant(query)):
+            mask[dataset.index[p.name], q] = 1
+    A = dataset.A.astype(dtype)
+    AT = A.T.tocsr()
+    tol = max(tol, 8 * np.finfo(dtype).eps)
+    hub = mask.copy()
+    authority = mask.copy()
+
+    # The book doesn't cover any convergence criteria; we stop once no
+    # authority score moves by more than tol (hub is a function of authority),
+    # or after max_iters iterations.
+    for __ in range(max_iters):
+        previous = authority
+        authority = AT.dot(hub) * mask
+        hub = A.dot(authority) * mask
+
+        # L2-normalize each column in place; all-zero columns are left as is.
+        for scores in (hub, authority):
+            norms = np.linalg.norm(scores, axis=0)
+            norms[norms == 0] = 1
+            scores /= norms
+        if np.abs(authority - previous).max(initial=0) < tol:
+            break
+
+    return [{dataset.nodes[i].name: (float(hub[i, q]), float(authority[i, q]))
+             for i in np.flatnonzero(mask[:, q])}
+            for q in range(len(queries))]
+
+
+if __name__ == '__main__':
+    r = HITS("fatih", Pages(network))
+    pr = '\n'.join("{}:\t{}, {}".format(p.name, p.hub, p.authority) for p in r)
+    print(pr)
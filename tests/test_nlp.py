@@ -1,5 +1,7 @@
+import numpy as np
 import pytest
 from nlp import *
+from nlp import _cyk_combine_loops, _cyk_combine_vectorized
 
 def test_rules():
     assert Rules(A = "B C | D E") == {'A': [['B', 'C'], ['D', 'E']]}
@@ -7,3 +9,101 @@ def test_rules():
 
 def test_lexicon():
     assert Lexicon(Art = "the | a | an") == {'Art': ['the', 'a', 'an']}
+
+
+def test_HITS():
+    pages = {p.name: p for p in HITS('fatih', Pages(network))}
+    assert set(pages) == {'fatih', 'erdem', 'mehmetbarancay', 'tayyiperdogdu', 'cemal',
+                          'taylan', 'yigit', 'serkan', 'tuna', 'cihanokyay', 'can', 'sinan'}
+    assert sum(p.authority ** 2 for p in pages.values()) == pytest.approx(1)
+    assert sum(p.hub ** 2 for p in pages.values()) == pytest.approx(1)
+    assert max(pages.values(), key=lambda p: p.authority).name == 'yigit'
+    assert pages['mehmetbarancay'].hub == 0
+    # HITS itself runs in float64 and honours a tight tolerance
+    pages = HITS('fatih', Pages(network), tol=1e-12)
+    assert sum(p.authority ** 2 for p in pages) == pytest.approx(1, abs=1e-12)
+
+
+def test_Pages():
+    pages = Pages(network)
+    assert all(p is pages._page(p.name) for p in pages.graph)
+    assert len(pages.nodes) == len(set(network) | {q for qs in network.values() for q in qs})
+    fatih = pages._page('fatih')
+    assert {p.name for p in pages.inlinks(fatih)} == {'erdem', 'can', 'sinan'}
+    assert len(pages.outlinks(fatih)) == len(network['fatih'])
+
+
+def test_Chart():
+    assert len(Chart(E0).parses('the stench is in 2 2')) == 1
+    assert len(Chart(E0).parses('I see the wumpus near the pit in 2 2 and you smell it')) == 5
+    assert len(Chart(E_).parses('the man saw the table')) == 1
+    assert Chart(E_).parses('saw the man') == []
+    [parse] = Chart(E_).parses('I feel it')
+    assert parse.expects == () and parse.rhs == ('NP', 'VP')
+    assert [(e.start, e.end, e.lhs) for e in parse.found] == [(0, 1, 'NP'), (1, 3, 'VP')]
+    assert repr(parse) == '[0:3 S -> NP VP .]'
+    assert repr(parse.parent) == '[0:1 S -> NP . VP]'
+    assert parse_tree(parse) == ('S', (('NP', (('Pronoun', 'I'),)),
+                                       ('VP', (('V', 'feel'), ('NP', (('Pronoun', 'it'),))))))
+
+
+def test_Grammar():
+    assert E0.categories['east'] == {'Noun', 'Adjective', 'Adverb'}
+    assert E0.isa('east', 'Adverb') and not E0.isa('east', 'Verb')
+    assert not E0.isa('unicorn', 'Noun') and 'unicorn' not in E0.categories
+    grammar = Grammar('E_empty', Rules(S='NP VP', NP='Art N', VP='V | V NP | '),
+                      Lexicon(Art='the', N='man', V='saw'))
+    [parse] = Chart(grammar).parses('the man')
+    assert parse_tree(parse) == ('S', (('NP', (('Art', 'the'), ('N', 'man'))), ('VP', ())))
+
+
+def test_generate_random():
+    assert E_.kind['S'] == 'R' and E_.kind['Art'] == 'L' and 'man' not in E_.kind
+    for _ in range(10):
+        assert len(Chart(E_).parses(generate_random(E_))) >= 1
+
+
+def test_CYK_parse():
+    assert ('NP', 'Art', 'N', 0.5) in E_.cnf_rules()
+    assert dict(E_.cnf_lexicon['I']) == {'Pronoun': pytest.approx(1/3), 'NP': pytest.approx(1/6)}
+    P = CYK_parse('I feel it'.split(), E_)
+    assert P['S', 0, 3] == pytest.approx(1/108)
+    assert P['VP', 1, 2] == pytest.approx(1/18)
+    assert CYK_parse('saw the man'.split(), E_)['S', 0, 3] == 0
+    assert CYK_parse('the stench is in 2 2'.split(), E0)['S', 0, 6] > 0
+    assert all(E0.id2sym[E0.sym2id[X]] == X for X in ('S', 'NP', 'Noun', 'Digit'))
+    words = ('the wumpus is in 2 2 and ' * 8 + 'I see it').split()
+    assert CYK_parse(words, E0)['S', 0, len(words)] > 0
+
+
+def test_HITS_batch():
+    pages = Pages(network)
+    fatih, johnresig = HITS_batch(['fatih', 'johnresig'], pages)
+    for p in HITS('johnresig', pages):
+        assert johnresig[p.name] == (pytest.approx(p.hub, abs=1e-6),
+                                     pytest.approx(p.authority, abs=1e-6))
+    assert set(fatih) == {p.name for p in HITS('fatih', pages)}
+    assert HITS_batch(['nobody'], pages) == [{}]
+
+
+def test_HITS_batch_converges():
+    pages = Pages(network)
+    # If the iteration stops once the scores settle, running longer changes nothing.
+    converged = HITS_batch(['johnresig'], pages, max_iters=60)
+    assert HITS_batch(['johnresig'], pages, max_iters=200) == converged
+    assert HITS_batch(['johnresig'], pages, max_iters=201) == converged
+    assert HITS_batch(['johnresig'], pages, max_iters=5) != converged
+
+
+def test_cyk_combine_vectorized():
+    words = 'I see the wumpus near the pit in 2 2 and you smell it'.split()
+    N = len(words)
+    P = np.full((len(E0.id2sym), N, N+1), -np.inf, dtype=np.float32)
+    for (i, word) in enumerate(words):
+        for (X, p) in E0.cnf_lexicon[word]:
+            P[E0.sym2id[X], i, 1] = np.log(p)
+    loops, vectorized = P.copy(), P.copy()
+    _cyk_combine_loops(loops, *E0.cnf_arrays, N)
+    _cyk_combine_vectorized(vectorized, *E0.cnf_arrays, N)
+    assert np.isfinite(loops[E0.sym2id['S'], 0, N])
+    assert np.allclose(loops, vectorized)